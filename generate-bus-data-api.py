@@ -4,144 +4,87 @@ Generate MBTA bus data using MBTA's V3 API for shapes.
 This should give us complete shape data for all routes.
 """
 
-import requests
-import json
+import orjson
+import shutil
 from pathlib import Path
 from tqdm import tqdm
-import time
+from tqdm.contrib.logging import logging_redirect_tqdm
+import logging
+import math
+import statistics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from mbta_api import (
+    API_KEY, MAX_WORKERS, SHAPES_BATCH_SIZE, MBTA_API_BASE_URL, RATE_LIMITER,
+    get_with_retry, get_route_shapes_bulk, get_route_stops, index_stops, write_bus_data
+)
+
+log = logging.getLogger('mbta')
+
+MIN_WORKERS = 4  # The actual count, up to MAX_WORKERS, is picked from measured latency
+WARMUP_REQUESTS = 10  # Requests made serially to measure latency before going parallel
+CACHE_DIR = Path(".cache/mbta")  # Per-route results of an unfinished run; removed once a run completes
 
 def get_bus_routes():
     """Get all bus routes from MBTA API"""
     print("Fetching bus routes from MBTA API...")
     
-    url = "https://api-v3.mbta.com/routes"
+    url = f"{MBTA_API_BASE_URL}/routes"
     params = {
         'filter[type]': '3',  # Bus routes only
         'page[limit]': 1000
     }
     
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        
-        data = response.json()
-        routes = data.get('data', [])
-        
-        print(f"Found {len(routes)} bus routes")
-        return routes
-        
-    except Exception as e:
-        print(f"Error fetching routes: {e}")
+    data = get_with_retry(url, params)
+    if data is None:
+        log.error("Error fetching routes")
         return []
-
-def get_route_shapes(route_id):
-    """Get shapes for a specific route"""
-    url = "https://api-v3.mbta.com/shapes"
-    params = {
-        'filter[route]': route_id,
-        'page[limit]': 100
-    }
     
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, params=params)
-            
-            if response.status_code == 429:  # Rate limited
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # Progressive backoff
-                    print(f"Rate limited, waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"Rate limited after {max_retries} attempts for route {route_id}")
-                    return []
-            
-            response.raise_for_status()
-            
-            data = response.json()
-            shapes = data.get('data', [])
-            
-            # Convert encoded polylines to coordinate arrays
-            decoded_shapes = []
-            for shape in shapes:
-                if 'polyline' in shape.get('attributes', {}):
-                    encoded_polyline = shape['attributes']['polyline']
-                    # For now, we'll store the encoded polyline - Leaflet can decode it directly
-                    decoded_shapes.append({
-                        'shape_id': shape['id'],
-                        'polyline': encoded_polyline
-                    })
-            
-            return decoded_shapes
-            
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Error fetching shapes for route {route_id} (attempt {attempt + 1}): {e}")
-                time.sleep(2)
-                continue
-            else:
-                print(f"Error fetching shapes for route {route_id} after {max_retries} attempts: {e}")
-                return []
-    
-    return []
-
-def get_route_stops(route_id):
-    """Get stops for a specific route"""
-    url = "https://api-v3.mbta.com/stops"
-    params = {
-        'filter[route]': route_id,
-        'page[limit]': 1000
-    }
+    routes = data.get('data', [])
     
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, params=params)
-            
-            if response.status_code == 429:  # Rate limited
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # Progressive backoff
-                    print(f"Rate limited, waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"Rate limited after {max_retries} attempts for route {route_id}")
-                    return []
-            
-            response.raise_for_status()
-            
-            data = response.json()
-            stops = data.get('data', [])
-            
-            # Convert to our format
-            formatted_stops = []
-            for stop in stops:
-                attributes = stop.get('attributes', {})
-                if 'latitude' in attributes and 'longitude' in attributes:
-                    formatted_stops.append({
-                        'name': attributes.get('name', 'Unknown'),
-                        'coords': [float(attributes['latitude']), float(attributes['longitude'])],
-                        'type': 'Bus',
-                        'stopId': stop['id']
-                    })
-            
-            return formatted_stops
-            
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Error fetching stops for route {route_id} (attempt {attempt + 1}): {e}")
-                time.sleep(2)
-                continue
-            else:
-                print(f"Error fetching stops for route {route_id} after {max_retries} attempts: {e}")
-                return []
-    
-    return []
+    print(f"Found {len(routes)} bus routes")
+    return routes
+
+def cache_path(route_id, kind):
+    """Path of the cached stops/shapes for a route"""
+    return CACHE_DIR / f"{route_id}.{kind}.json"
+
+def read_cache(route_id, kind):
+    """Return the cached stops/shapes for a route, or None if not fetched yet"""
+    path = cache_path(route_id, kind)
+    if not path.exists():
+        return None
+    return orjson.loads(path.read_bytes())
+
+def write_cache(route_id, kind, data):
+    """Cache the stops/shapes for a route so later runs can skip fetching them"""
+    path = cache_path(route_id, kind)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(orjson.dumps(data))
+    tmp.replace(path)
+
+def iter_cached(route_ids, kind):
+    """Yield (route_id, data) in route order for every route with cached data of this kind"""
+    for route_id in route_ids:
+        data = read_cache(route_id, kind)
+        if data:
+            yield route_id, data
+
+
+def choose_worker_count(latencies):
+    """Pick enough workers to keep RATE_LIMITER saturated given the measured request latency"""
+    if not latencies:
+        return MIN_WORKERS
+    
+    # Requests in flight = request rate * time per request
+    median_latency = statistics.median(latencies)
+    return max(MIN_WORKERS, min(MAX_WORKERS, math.ceil(RATE_LIMITER.rate * median_latency)))
 
 def generate_bus_data():
     """Generate complete bus data using MBTA API"""
     print("Starting bus data generation using MBTA API...")
+    if not API_KEY:
+        print("MBTA_API_KEY is not set; requests are limited to 20/minute, so this will be slow")
     
     # Get all bus routes
     routes = get_bus_routes()
@@ -149,79 +92,106 @@ def generate_bus_data():
         print("No routes found")
         return
     
-    # Generate bus data
-    mbta_bus_data = {}
-    bus_route_shapes = {}
+    route_ids = [route['id'] for route in routes]
+    
+    # Routes fetched by an interrupted earlier run are served from the cache
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    missing_stops = [route_id for route_id in route_ids if not cache_path(route_id, 'stops').exists()]
+    missing_shapes = [route_id for route_id in route_ids if not cache_path(route_id, 'shapes').exists()]
+    if len(missing_stops) < len(route_ids) or len(missing_shapes) < len(route_ids):
+        print(f"Resuming interrupted run from {CACHE_DIR}: stops cached for "
+              f"{len(route_ids) - len(missing_stops)} routes, shapes for {len(route_ids) - len(missing_shapes)} routes")
+    
+    # Fetch the first few routes serially to measure request latency; their results are kept.
+    # Only clean first-attempt round trips count, so rate limiting can't inflate the estimate.
+    latencies = []
+    for route_id in missing_stops[:WARMUP_REQUESTS]:
+        stops = get_route_stops(route_id, latencies=latencies)
+        if stops is not None:
+            write_cache(route_id, 'stops', stops)
+    missing_stops = missing_stops[WARMUP_REQUESTS:]
+    
+    workers = choose_worker_count(latencies)
+    if latencies:
+        print(f"Median request latency {statistics.median(latencies) * 1000:.0f} ms, using {workers} workers")
+    else:
+        print(f"No clean latency samples, using {workers} workers")
     
     print("Processing routes...")
-    for route in tqdm(routes, desc="Processing routes"):
-        route_id = route['id']
-        route_name = route.get('attributes', {}).get('long_name', 'Unknown')
-        
-        print(f"Processing route {route_id}: {route_name}")
-        
-        # Get stops for this route
-        stops = get_route_stops(route_id)
-        print(f"  Found {len(stops)} stops")
-        
-        # Get shapes for this route
-        shapes = get_route_shapes(route_id)
-        print(f"  Found {len(shapes)} shapes")
-        
-        # Store the data
-        if stops:
-            mbta_bus_data[route_id] = stops
-        
-        if shapes:
-            bus_route_shapes[route_id] = shapes
+    # Fetch stops per route and shapes in batches of routes, concurrently;
+    # RATE_LIMITER keeps us under the API limit
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for route_id in missing_stops:
+            futures[executor.submit(get_route_stops, route_id)] = ('stops', route_id)
+        for i in range(0, len(missing_shapes), SHAPES_BATCH_SIZE):
+            batch = missing_shapes[i:i + SHAPES_BATCH_SIZE]
+            futures[executor.submit(get_route_shapes_bulk, batch)] = ('shapes', batch)
         
-        # Rate limiting - be more respectful of the API
-        time.sleep(0.5)  # 500ms between requests
-    
-    print(f"Generated data for {len(mbta_bus_data)} routes")
-    print(f"Generated shapes for {len(bus_route_shapes)} routes")
+        # Route log messages through tqdm so they don't break up the progress bar
+        with logging_redirect_tqdm():
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing routes"):
+                kind, key = futures[future]
+                result = future.result()
+                
+                # Store the data; failed fetches (None) stay uncached so a rerun retries them
+                if result is None:
+                    continue
+                if kind == 'stops':
+                    log.debug(f"Route {key}: found {len(result)} stops")
+                    write_cache(key, 'stops', result)
+                else:
+                    log.debug(f"Found shapes for {len(result)} of {len(key)} routes")
+                    # Routes without shapes are cached as empty so they count as fetched
+                    for route_id in key:
+                        write_cache(route_id, 'shapes', result.get(route_id, []))
     
-    # Save to files
     output_dir = Path(".")
-    
-    # Save as JavaScript file
     js_file = output_dir / "mbta-bus-data.js"
-    with open(js_file, 'w', encoding='utf-8') as f:
-        f.write("const mbtaBusData = ")
-        json.dump(mbta_bus_data, f, indent=2, ensure_ascii=False)
-        f.write(";\n\n")
-        
-        f.write("const busRouteShapes = ")
-        json.dump(bus_route_shapes, f, indent=2, ensure_ascii=False)
-        f.write(";\n\n")
-    
-    print(f"Saved bus data to {js_file}")
-    
-    # Save as JSON file for reference
     json_file = output_dir / "mbta-bus-data.json"
-    with open(json_file, 'w', encoding='utf-8') as f:
-        json.dump({
-            'mbtaBusData': mbta_bus_data,
-            'busRouteShapes': bus_route_shapes
-        }, f, indent=2, ensure_ascii=False)
     
+    # Stream each route's cached entry to disk one at a time.
+    # Routes list stop IDs; each stop shared between routes is written once to busStops
+    bus_stops = {}
+    routes_with_stops, routes_with_shapes = write_bus_data(
+        js_file, json_file,
+        ((route_id, index_stops(stops, bus_stops)) for route_id, stops in iter_cached(route_ids, 'stops')),
+        bus_stops,
+        iter_cached(route_ids, 'shapes')
+    )
+    
+    # The cache only exists to resume an interrupted or partly failed run; once
+    # every route was fetched the next run starts fresh
+    complete = all(cache_path(route_id, kind).exists() for route_id in route_ids for kind in ('stops', 'shapes'))
+    if complete:
+        shutil.rmtree(CACHE_DIR)
+        if not any(CACHE_DIR.parent.iterdir()):
+            CACHE_DIR.parent.rmdir()
+    
+    print(f"Generated data for {len(routes_with_stops)} routes ({len(bus_stops)} unique stops)")
+    print(f"Generated shapes for {len(routes_with_shapes)} routes")
+    print(f"Saved bus data to {js_file}")
     print(f"Saved JSON reference to {json_file}")
+    print(f"Saved gzip-compressed copies to {js_file}.gz and {json_file}.gz")
+    if not complete:
+        print(f"Some routes failed to fetch; kept {CACHE_DIR} so a rerun will resume and only fetch those")
     
     # Print summary
     print("\n" + "="*50)
     print("BUS DATA GENERATION COMPLETE")
     print("="*50)
-    print(f"Total routes processed: {len(mbta_bus_data)}")
-    print(f"Routes with shapes: {len(bus_route_shapes)}")
+    print(f"Total routes processed: {len(routes_with_stops)}")
+    print(f"Routes with shapes: {len(routes_with_shapes)}")
     
     # Calculate routes that have both stops and shapes
-    routes_with_both = set(mbta_bus_data.keys()) & set(bus_route_shapes.keys())
-    routes_with_stops_only = set(mbta_bus_data.keys()) - set(bus_route_shapes.keys())
-    routes_with_shapes_only = set(bus_route_shapes.keys()) - set(mbta_bus_data.keys())
+    routes_with_both = set(routes_with_stops) & set(routes_with_shapes)
+    routes_with_stops_only = set(routes_with_stops) - set(routes_with_shapes)
+    routes_with_shapes_only = set(routes_with_shapes) - set(routes_with_stops)
     
     print(f"Routes with both stops and shapes: {len(routes_with_both)}")
     print(f"Routes with stops only: {len(routes_with_stops_only)}")
     print(f"Routes with shapes only: {len(routes_with_shapes_only)}")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
     generate_bus_data()
@@ -0,0 +1,264 @@
+"""
+Shared MBTA V3 API client and output helpers for the bus data scripts
+(generate-bus-data-api.py and retry-failed-routes.py).
+"""
+
+import requests
+import orjson
+import gzip
+import shutil
+import time
+import logging
+import random
+import math
+import os
+import threading
+
+log = logging.getLogger('mbta')
+
+MAX_WORKERS = 16  # Most worker threads that share SESSION at once
+SHAPES_BATCH_SIZE = 25  # Routes per route_patterns request
+REQUEST_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+API_KEY = os.environ.get('MBTA_API_KEY')  # Free key from https://api-v3.mbta.com/register
+MAX_RETRIES = 3
+
+# MBTA V3 API endpoints; per-request params only add filter[route] to these templates
+MBTA_API_BASE_URL = "https://api-v3.mbta.com"
+STOPS_URL = f"{MBTA_API_BASE_URL}/stops"
+STOPS_PARAMS_BASE = {
+    'fields[stop]': 'name,latitude,longitude',  # Only the attributes we use
+    'page[limit]': 1000
+}
+ROUTE_PATTERNS_URL = f"{MBTA_API_BASE_URL}/route_patterns"
+SHAPES_PARAMS_BASE = {
+    'include': 'representative_trip.shape',
+    'fields[shape]': 'polyline',  # Only the attributes we use
+    'page[limit]': 1000
+}
+
+# Shared HTTP session so connections to the MBTA API are reused across requests.
+# Everything goes to a single host, so one pool with a keep-alive connection per
+# worker; pool_block makes a worker wait for a free connection rather than
+# opening (and then discarding) an extra one.
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'  # JSON:API responses compress very well
+if API_KEY:
+    SESSION.headers['x-api-key'] = API_KEY
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=MAX_WORKERS, pool_block=True, max_retries=0))
+
+class RateLimiter:
+    """Token bucket shared by all worker threads to stay under the API rate limit"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request token is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+# MBTA allows 1000 requests/minute with an API key but only 20 requests/minute
+# without one; stay a little below whichever limit applies
+if API_KEY:
+    RATE_LIMITER = RateLimiter(rate=15, burst=15)
+else:
+    RATE_LIMITER = RateLimiter(rate=0.3, burst=1)
+
+# Rate limits and transient server errors are worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER = 60  # Seconds; cap on how long a Retry-After header can stall a worker
+
+def get_with_retry(url, params, max_retries=MAX_RETRIES, latencies=None):
+    """GET an MBTA API endpoint, backing off on rate limits and server errors.
+
+    If a latencies list is given, the round-trip time of a request that succeeds
+    on its first attempt is appended to it (rate limiting and retries excluded).
+
+    Returns the decoded JSON body, or None if every attempt failed.
+    """
+    for attempt in range(max_retries):
+        wait_time = 2 ** attempt  # Exponential backoff unless the server says otherwise
+        try:
+            RATE_LIMITER.acquire()
+            start = time.monotonic()
+            response = SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            elapsed = time.monotonic() - start
+            
+            if response.status_code not in RETRY_STATUS_CODES:
+                if 400 <= response.status_code < 500:
+                    # Other client errors won't succeed on a retry
+                    log.debug(f"HTTP {response.status_code} from {url}, not retrying")
+                    return None
+                response.raise_for_status()
+                if latencies is not None and attempt == 0:
+                    latencies.append(elapsed)
+                return orjson.loads(response.content)
+            
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    server_wait = float(retry_after)
+                except ValueError:
+                    server_wait = math.nan  # HTTP-date form; keep the exponential backoff
+                if not math.isnan(server_wait):
+                    wait_time = min(max(server_wait, 0.0), MAX_RETRY_AFTER)
+            log.debug(f"HTTP {response.status_code} from {url} (attempt {attempt + 1})")
+            
+        except Exception as e:
+            log.debug(f"Error fetching {url} (attempt {attempt + 1}): {e}")
+        
+        if attempt < max_retries - 1:
+            time.sleep(wait_time + random.uniform(0, 0.25))
+    
+    return None
+
+def get_route_shapes_bulk(route_ids, max_retries=MAX_RETRIES):
+    """Get shapes for a batch of routes in a single request.
+
+    Shape resources don't say which route they belong to, so they are fetched
+    through route patterns: each pattern names its route and its representative
+    trip, and that trip names its shape.
+
+    This returns one shape per route pattern (its representative trip's shape),
+    not every shape /shapes?filter[route]= used to return, so a route can end up
+    with fewer drawn variants than before (e.g. one-off short-turn trips that
+    share a pattern with a longer trip are no longer drawn separately).
+
+    Returns {route_id: shapes} for the routes that have shapes, or None if the
+    request failed.
+    """
+    params = {**SHAPES_PARAMS_BASE, 'filter[route]': ','.join(route_ids)}
+    data = get_with_retry(ROUTE_PATTERNS_URL, params, max_retries=max_retries)
+    if data is None:
+        log.warning(f"Failed to fetch shapes for routes {', '.join(route_ids)}")
+        return None
+    
+    included = {(item['type'], item['id']): item for item in data.get('included', [])}
+    
+    route_shapes = {}
+    for pattern in data.get('data', []):
+        relationships = pattern.get('relationships', {})
+        route_id = (relationships.get('route', {}).get('data') or {}).get('id')
+        trip_ref = relationships.get('representative_trip', {}).get('data') or {}
+        trip = included.get(('trip', trip_ref.get('id')), {})
+        shape_ref = trip.get('relationships', {}).get('shape', {}).get('data') or {}
+        shape = included.get(('shape', shape_ref.get('id')))
+        if not route_id or not shape or 'polyline' not in shape.get('attributes', {}):
+            continue
+        
+        # Several patterns on a route can share one shape
+        shapes = route_shapes.setdefault(route_id, [])
+        if any(existing['shape_id'] == shape['id'] for existing in shapes):
+            continue
+        
+        # Keep the encoded polyline: it is ~7x smaller than decoded coordinates
+        # and the map decodes it faster than it could parse the coordinate arrays
+        shapes.append({
+            'shape_id': shape['id'],
+            'polyline': shape['attributes']['polyline']
+        })
+    
+    return route_shapes
+
+def get_route_stops(route_id, max_retries=MAX_RETRIES, latencies=None):
+    """Get stops for a specific route, or None if the request failed"""
+    params = {**STOPS_PARAMS_BASE, 'filter[route]': route_id}
+    data = get_with_retry(STOPS_URL, params, max_retries=max_retries, latencies=latencies)
+    if data is None:
+        log.warning(f"Failed to fetch stops for route {route_id}")
+        return None
+    
+    stops = data.get('data', [])
+    
+    # Convert to our format
+    formatted_stops = []
+    for stop in stops:
+        attributes = stop.get('attributes', {})
+        if 'latitude' in attributes and 'longitude' in attributes:
+            formatted_stops.append({
+                'name': attributes.get('name', 'Unknown'),
+                'coords': [float(attributes['latitude']), float(attributes['longitude'])],
+                'type': 'Bus',
+                'stopId': stop['id']
+            })
+    
+    return formatted_stops
+
+def index_stops(stops, bus_stops):
+    """Add stops to the shared stop table and return the route's list of stop IDs"""
+    for stop in stops:
+        bus_stops.setdefault(stop['stopId'], {'name': stop['name'], 'coords': stop['coords']})
+    return [stop['stopId'] for stop in stops]
+
+def write_gzip_copy(path):
+    """Write a gzip-compressed copy of path next to it, for servers that serve precompressed files"""
+    gz_path = path.with_name(path.name + ".gz")
+    with open(path, 'rb') as src, gzip.open(gz_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    return gz_path
+
+def stream_object(files, entries):
+    """Write (key, value) pairs to each file as a JSON object, one entry per line.
+
+    Each entry is serialized and written on its own, so the whole object never
+    has to be held in memory. Returns the keys that were written.
+    """
+    keys = []
+    for f in files:
+        f.write(b"{")
+    for key, value in entries:
+        entry = (b",\n  " if keys else b"\n  ") + orjson.dumps(key) + b": " + orjson.dumps(value)
+        for f in files:
+            f.write(entry)
+        keys.append(key)
+    for f in files:
+        f.write(b"\n}")
+    return keys
+
+def write_bus_data(js_file, json_file, route_stops, bus_stops, route_shapes):
+    """Write mbtaBusData, busStops and busRouteShapes to the .js and .json outputs.
+
+    route_stops and route_shapes are iterables of (route_id, value) pairs that
+    are streamed out one entry at a time. bus_stops is written after route_stops
+    has been consumed, so route_stops may fill it while it is iterated. Output
+    goes to .tmp files that only replace the real ones once writing succeeded,
+    followed by gzip-compressed copies.
+
+    Returns the route IDs written with stops and with shapes.
+    """
+    js_tmp = js_file.with_name(js_file.name + ".tmp")
+    json_tmp = json_file.with_name(json_file.name + ".tmp")
+    with open(js_tmp, 'wb') as js_out, open(json_tmp, 'wb') as json_out:
+        js_out.write(b"const mbtaBusData = ")
+        json_out.write(b'{"mbtaBusData": ')
+        routes_with_stops = stream_object([js_out, json_out], route_stops)
+        
+        js_out.write(b";\n\nconst busStops = ")
+        json_out.write(b',\n"busStops": ')
+        stream_object([js_out, json_out], bus_stops.items())
+        
+        js_out.write(b";\n\nconst busRouteShapes = ")
+        json_out.write(b',\n"busRouteShapes": ')
+        routes_with_shapes = stream_object([js_out, json_out], route_shapes)
+        js_out.write(b";\n\n")
+        json_out.write(b"}\n")
+    
+    js_tmp.replace(js_file)
+    json_tmp.replace(json_file)
+    write_gzip_copy(js_file)
+    write_gzip_copy(json_file)
+    
+    return routes_with_stops, routes_with_shapes
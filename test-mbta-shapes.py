@@ -6,6 +6,12 @@ Test script to check MBTA's shapes API endpoint
 import requests
 import json
 
+# Shared HTTP session so connections to the MBTA API are reused across requests
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'  # JSON:API responses compress very well
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+REQUEST_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+
 def test_mbta_shapes_api():
     """Test the MBTA shapes API endpoint"""
     
@@ -23,7 +29,7 @@ def test_mbta_shapes_api():
         }
         
         try:
-            response = requests.get(url, params=params)
+            response = SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
             print(f"Status: {response.status_code}")
             
             if response.status_code == 200: